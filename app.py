@@ -1,54 +1,820 @@
+# Run directly (python app.py), patch before anything imports sockets or threads,
+# the same as wsgi.py does under gunicorn.
+if __name__ == "__main__":
+    from gevent import monkey
+
+    monkey.patch_all()
+
+import contextlib
+import functools
+import hashlib
+import math
 import os
+import queue
 import re
+import threading
 import urllib.parse
-import requests
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import httpx2
+import orjson
+import urllib3
+from cachetools import TTLCache
 import logging # <--- NEW
 import time # <--- NEW
-from flask import Flask, request, jsonify
-from openai import OpenAI
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import JSONProvider
+from openai import APIConnectionError, DefaultHttpxClient, InternalServerError, OpenAI, RateLimitError
+from flask_compress import Compress
 from flask_cors import CORS
 from dotenv import load_dotenv
 
 # --- CONFIG ---
 ISGD_API = "https://is.gd/create.php?format=simple&url="
+ISGD_MAX_WORKERS = 32  # shared by all requests in a worker process
+ISGD_TIMEOUT = 6  # seconds for a lookup (retry included) and for the whole fan-out
+ISGD_ATTEMPT_TIMEOUT = 2.5  # seconds per attempt, connect + read; both attempts fit in ISGD_TIMEOUT
+ISGD_CACHE_SIZE = 10000
+ISGD_CACHE_TTL = 86400  # seconds
+ISGD_FAILURE_TTL = 60  # seconds before a failed URL is tried again
+ISGD_LINK_LENGTH = 20  # len("https://is.gd/xxxxxx"), budgeted for each masked link
+ISGD_BREAKER_FAILS = 5  # consecutive failures before is.gd is skipped...
+ISGD_BREAKER_RESET = 30  # ...for this many seconds
+ISGD_MIN_SAVING = 8  # URLs no longer than ISGD_LINK_LENGTH + this are kept as they are
+# Trailing sentence punctuation is left out of the match itself, not stripped afterwards
+_URL_RE = re.compile(r'https?://[^\s]*[^\s.,;!?]')
+_URL_TOKEN_RE = re.compile(r'__URL(\d+)__')
+_SPACES_RE = re.compile(r'[ \t]+')
+# Tail of a streamed reply that can't be sent yet: the last (possibly partial) word,
+# which may be an unfinished __URLn__ token, and any spaces/punctuation before it
+_STREAM_HOLD_RE = re.compile(r'[\s.,]*\S*$')
+# GSM 03.38 default alphabet and its extension table (ESC itself excluded)
+GSM_BASIC_CHARS = (
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+GSM_EXTENDED_CHARS = "^{}\\[~]|€\f"
+_NON_GSM_RE = re.compile(f"[^{re.escape(GSM_BASIC_CHARS + GSM_EXTENDED_CHARS)}]")
+_GSM_EXTENDED_RE = re.compile(f"[{re.escape(GSM_EXTENDED_CHARS)}]")
+_BATCH_MARKER_RE = re.compile(r'^[ \t]*### (\d+) ###[ \t]*$\n?', re.MULTILINE)
+BATCH_MAX_ITEMS = 50
+BATCH_FALLBACK_WORKERS = 8
+ASYNC_MAX_ITEMS = 1000
+COALESCE_MAX_ITEMS = 10
+OPENAI_MODEL = "gpt-4o-mini"
+OPENAI_TIMEOUT = 30  # seconds per attempt (SDK default is 10 minutes)
+OPENAI_CONNECT_TIMEOUT = 5  # seconds; fail over to a retry fast if the connect stalls
+OPENAI_KEEPALIVE = 60  # seconds an idle pooled connection is kept open
+CAP_TRIM_CHARS = ". ,"  # stripped from the end of a reply cut at max_chars
+MIN_MAX_TOKENS = 32  # floor for tiny max_chars, so a short reply isn't cut mid-word
+OPENAI_MAX_RETRIES = 2  # SDK retries 429/5xx/timeouts with jittered exponential backoff
+OPENAI_BREAKER_FAILS = 5  # consecutive failed calls (after those retries) before failing fast...
+OPENAI_BREAKER_RESET = 30  # ...for this many seconds
+# Sent verbatim as the system message of every call; everything that varies per
+# request goes in the user message after it, so the prefix stays byte-identical
+# and eligible for OpenAI's automatic prompt caching.
+STATIC_PROMPT_HEADER = """You are a precise SMS message shortener and translator.
+
+Rules:
+- Maintain the original meaning.
+- If multiple links exist, keep them all.
+- Links appear as tokens like __URL0__. Copy each token exactly as written.
+- Provide ONLY the final SMS text. No intro/outro."""
+RESP_CACHE_SIZE = 10000
+RESP_CACHE_TTL = 3600  # seconds
+COMPLETION_CACHE_SIZE = 50000
+COMPLETION_CACHE_TTL = 86400  # seconds
 
 # --- SETUP ---
+class ORJSONProvider(JSONProvider):
+    """orjson for jsonify() and request.json: several times faster than the stdlib on small dicts."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+class TokenBucket:
+    """Blocking token bucket refilled at `per_minute` units/min; a rate of 0 disables it."""
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self._tokens = float(per_minute)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: int = 1):
+        if not self.capacity:
+            return
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.capacity / 60)
+                self._updated = now
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return
+                delay = (amount - self._tokens) * 60 / self.capacity
+            time.sleep(delay)
+
+class CircuitOpenError(Exception):
+    pass
+
+class IsgdRateLimited(Exception):
+    pass
+
+class CircuitBreaker:
+    """Fails fast for `reset_timeout` seconds after `fail_max` consecutive failures,
+    then lets calls through again; the next failure re-opens it."""
+
+    def __init__(self, name: str, fail_max: int, reset_timeout: float):
+        self.name = name
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            return self._failures < self.fail_max or time.monotonic() - self._opened_at >= self.reset_timeout
+
+    def check(self):
+        if not self.allow():
+            raise CircuitOpenError(f"{self.name} is unavailable, try again shortly")
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.fail_max:
+                if self._failures == self.fail_max:
+                    logger.warning(f"[{self.name}] {self._failures} failures in a row, pausing calls for {self.reset_timeout}s")
+                self._opened_at = time.monotonic()
+
+class RequestCoalescer:
+    """Groups /shorten calls with the same options that arrive within `window` seconds
+    into one batch completion. The first caller of a group waits out the window (or
+    until the group is full), runs the batch and hands each caller its own result.
+    """
+
+    def __init__(self, window: float, max_items: int):
+        self.window = window
+        self.max_items = max_items
+        self._groups: dict[tuple, dict] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, masked_text: str, urls: list[str], shortening, max_chars: int, business_sector: str,
+               protect_variables: bool, target_language: str) -> tuple[dict, int | None]:
+        key = (business_sector, protect_variables, target_language)
+        entry = (masked_text, urls, shortening, max_chars, Future())
+        with self._lock:
+            group = self._groups.get(key)
+            leader = group is None
+            if leader:
+                group = self._groups[key] = {"entries": [], "full": threading.Event()}
+            group["entries"].append(entry)
+            if len(group["entries"]) >= self.max_items:
+                del self._groups[key]  # closed: later callers start a new group
+                group["full"].set()
+        if not leader:
+            return entry[4].result()
+
+        group["full"].wait(self.window)
+        with self._lock:
+            if self._groups.get(key) is group:
+                del self._groups[key]
+        entries = group["entries"]
+
+        try:
+            if len(entries) == 1:
+                outcomes = [complete_message(masked_text, urls, shortening, max_chars, *key)]
+            else:
+                results, tokens = complete_batch(
+                    [(e[0], e[1]) for e in entries], [e[2] for e in entries], [e[3] for e in entries], *key
+                )
+                outcomes = list(zip(results, tokens))
+        except Exception as e:
+            for *_, fut in entries:
+                fut.set_exception(e)
+            raise
+        for (*_, fut), outcome in zip(entries, outcomes):
+            fut.set_result(outcome)
+        return outcomes[0]
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app)
+# Brotli (gzip for older clients) on JSON and the batch JSONL passthrough; bodies
+# under COMPRESS_MIN_SIZE (500 bytes) go out as they are. The plain-text /shorten
+# stream is left alone so each piece is flushed as soon as it's written.
+app.config.update(
+    COMPRESS_MIMETYPES=["application/json", "application/x-ndjson"],
+    COMPRESS_ALGORITHM=["br", "gzip"],
+    COMPRESS_BR_LEVEL=4,
+)
+Compress(app)
 load_dotenv()
 
 # Configure Logging to print to Render Console
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-SESSION = requests.Session()
-SESSION.headers.update({"User-Agent": "TxtTrim/1.0"})
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", 64))
+# Keep-alive pool sized to the in-flight cap, so every concurrent call can reuse a
+# warm connection instead of paying a fresh TCP + TLS handshake.
+client = OpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    max_retries=OPENAI_MAX_RETRIES,
+    http_client=DefaultHttpxClient(
+        limits=httpx2.Limits(
+            max_connections=OPENAI_MAX_CONCURRENCY,
+            max_keepalive_connections=OPENAI_MAX_CONCURRENCY,
+            keepalive_expiry=OPENAI_KEEPALIVE,
+        ),
+        timeout=httpx2.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+    ),
+)
+# Throttle ourselves to the account's OpenAI limits (set OPENAI_RPM / OPENAI_TPM to
+# your tier) so bursts queue here instead of collecting 429s and retry backoff,
+# and cap in-flight calls so a burst can't exhaust sockets.
+OPENAI_REQUEST_BUCKET = TokenBucket(int(os.getenv("OPENAI_RPM", 0)))
+OPENAI_TOKEN_BUCKET = TokenBucket(int(os.getenv("OPENAI_TPM", 0)))
+OPENAI_SEMAPHORE = threading.BoundedSemaphore(OPENAI_MAX_CONCURRENCY)
+# During an OpenAI outage, fail requests in a millisecond instead of each one
+# sitting through the timeout and every retry.
+OPENAI_BREAKER = CircuitBreaker("OpenAI", OPENAI_BREAKER_FAILS, OPENAI_BREAKER_RESET)
+# Off by default: set OPENAI_COALESCE_MS to hold /shorten calls that long and send
+# any that arrive together as one batch completion (saves RPM and per-call overhead)
+COALESCER = RequestCoalescer(int(os.getenv("OPENAI_COALESCE_MS", 0)) / 1000, COALESCE_MAX_ITEMS)
+# Plain urllib3 for the fixed is.gd GET: same keep-alive pooling as requests.Session
+# without its per-call overhead (cookies, hooks, request preparation).
+# Pool sized to match the is.gd fan-out so parallel lookups reuse connections.
+HTTP = urllib3.PoolManager(
+    num_pools=2,
+    maxsize=ISGD_MAX_WORKERS,
+    headers={"User-Agent": "TxtTrim/1.0"},
+    timeout=urllib3.Timeout(total=ISGD_ATTEMPT_TIMEOUT),
+    # One retry for a dropped connection or a 5xx blip. Not 502: that's is.gd's
+    # rate-limit answer, and hitting it again straight away only makes it worse.
+    retries=urllib3.Retry(total=1, redirect=False, status_forcelist=(500, 503, 504)),
+)
+# While is.gd is down, messages keep their original URLs rather than each
+# waiting out the lookup deadline.
+ISGD_BREAKER = CircuitBreaker("is.gd", ISGD_BREAKER_FAILS, ISGD_BREAKER_RESET)
+# One long-lived pool for is.gd lookups (greenlets under the gevent worker),
+# so a request only queues work instead of spinning threads up and down.
+ISGD_POOL = ThreadPoolExecutor(max_workers=ISGD_MAX_WORKERS, thread_name_prefix="isgd")
+ISGD_CACHE = TTLCache(maxsize=ISGD_CACHE_SIZE, ttl=ISGD_CACHE_TTL)
+ISGD_FAILURES = TTLCache(maxsize=ISGD_CACHE_SIZE, ttl=ISGD_FAILURE_TTL)
+ISGD_CACHE_LOCK = threading.Lock()  # TTLCache is not thread-safe
+# Same for single calls when a /shorten_batch reply can't be split (separate from
+# ISGD_POOL, which those calls submit into)
+FALLBACK_POOL = ThreadPoolExecutor(max_workers=BATCH_FALLBACK_WORKERS, thread_name_prefix="batch-fallback")
+# Reads streamed completions for "stream": true callers, so an OpenAI slot is
+# released at the model's pace rather than the caller's
+STREAM_POOL = ThreadPoolExecutor(max_workers=OPENAI_MAX_CONCURRENCY, thread_name_prefix="openai-stream")
+# Finished /shorten payloads, so a template sent to many recipients costs one OpenAI call
+RESP_CACHE = TTLCache(maxsize=RESP_CACHE_SIZE, ttl=RESP_CACHE_TTL)
+RESP_CACHE_LOCK = threading.Lock()  # TTLCache is not thread-safe
+# Model output for a masked message + options, reused across different links
+COMPLETION_CACHE = TTLCache(maxsize=COMPLETION_CACHE_SIZE, ttl=COMPLETION_CACHE_TTL)
+COMPLETION_CACHE_LOCK = threading.Lock()
+# Identical requests already being worked on; later arrivals wait on the first one's result
+INFLIGHT: dict[bytes, Future] = {}
+INFLIGHT_LOCK = threading.Lock()
 
 # --- HELPERS ---
+def _isgd_lookup(url: str) -> str:
+    encoded = urllib.parse.quote_plus(url)
+    r = HTTP.request("GET", ISGD_API + encoded)
+    if r.status == 200 and r.data.startswith(b"http"):
+        return r.data.decode().strip()
+    if r.status in (429, 502):  # 502 is how is.gd says "slow down"
+        raise IsgdRateLimited(f"HTTP {r.status}: rate limited")
+    raise ValueError(f"HTTP {r.status}: {r.data[:200]!r}")
+
 def _shorten_with_isgd(url: str) -> str | None:
+    # is.gd returns the same short link for a given URL, so results are cached for
+    # a day; failures are remembered briefly so a bad URL isn't retried every request.
+    with ISGD_CACHE_LOCK:
+        if url in ISGD_FAILURES:
+            return None
+        short = ISGD_CACHE.get(url)
+    if short:
+        return short
+    if not ISGD_BREAKER.allow():
+        return None
+
     try:
-        encoded = urllib.parse.quote_plus(url)
-        r = SESSION.get(ISGD_API + encoded, timeout=6)
-        if r.status_code == 200 and r.text.startswith("http"):
-            return r.text.strip()
+        short = _isgd_lookup(url)
     except Exception as e:
         logger.error(f"[is.gd Error] {e}") # <--- LOG ERROR
-    return None
+        # An unreachable, erroring or rate-limiting is.gd counts against the
+        # breaker; a URL it refused says nothing either way
+        if isinstance(e, (urllib3.exceptions.HTTPError, IsgdRateLimited)):
+            ISGD_BREAKER.record_failure()
+        with ISGD_CACHE_LOCK:
+            ISGD_FAILURES[url] = True
+        return None
+    ISGD_BREAKER.record_success()
+    with ISGD_CACHE_LOCK:
+        ISGD_CACHE[url] = short
+    return short
+
+def mask_urls(text: str) -> tuple[str, list[str]]:
+    """Replace each distinct URL with a __URLn__ token; returns the masked text and the URLs by n."""
+    # Most messages carry no link at all; a substring test settles that without
+    # running the regex engine over the whole text.
+    if "://" not in text:
+        return text, []
+    urls: list[str] = []
+    index: dict[str, int] = {}
+    # One scan, spliced with str.join rather than a Python callback per match
+    out, last = [], 0
+    for m in _URL_RE.finditer(text):
+        u = m.group(0)
+        i = index.get(u)
+        if i is None:
+            i = index[u] = len(urls)
+            urls.append(u)
+        out.append(text[last:m.start()])
+        out.append(_url_token(i))
+        last = m.end()
+    if not urls:
+        return text, urls
+    out.append(text[last:])
+    return "".join(out), urls
+
+def unmask_urls(text: str, links: list[str]) -> str:
+    # One scan for all tokens, rather than a str.replace pass per link
+    if not links:
+        return text
+    out, last = [], 0
+    for m in _URL_TOKEN_RE.finditer(text):
+        i = int(m.group(1))
+        if i < len(links):
+            out.append(text[last:m.start()])
+            out.append(links[i])
+            last = m.end()
+    out.append(text[last:])
+    return "".join(out)
+
+def _url_token(i: int) -> str:
+    return f"__URL{i}__"
+
+def _worth_shortening(url: str) -> bool:
+    # A link that is already about as short as an is.gd one isn't worth the round trip
+    return len(url) > ISGD_LINK_LENGTH + ISGD_MIN_SAVING
+
+def start_url_shortening(urls: list[str]):
+    """Kick off is.gd lookups in the background; pass the handle to finish_url_shortening."""
+    futures = [ISGD_POOL.submit(_shorten_with_isgd, u) if _worth_shortening(u) else None for u in urls]
+    return {"futures": futures, "deadline": time.time() + ISGD_TIMEOUT, "links": None}
+
+def finish_url_shortening(handle, urls: list[str]) -> list[str]:
+    """Collect short links; the whole batch shares one deadline and stragglers keep their original URL.
+
+    The links are settled on the first call; later calls return the same list, even
+    if a straggler has finished since.
+    """
+    if handle["links"] is not None:
+        return handle["links"]
+    futures = handle["futures"]
+    wait([f for f in futures if f], timeout=max(0, handle["deadline"] - time.time()))
+    links = []
+    for u, fut in zip(urls, futures):
+        if fut is None:
+            links.append(u)
+            continue
+        fut.cancel()  # no-op unless the lookup is still queued behind other requests
+        short = fut.result() if fut.done() and not fut.cancelled() else None
+        links.append(short or u)
+    handle["links"] = links
+    return links
+
+def _all_shortened(urls: list[str], links: list[str]) -> bool:
+    # False if a lookup failed, timed out or was skipped by the breaker
+    return all(link != u for u, link in zip(urls, links) if _worth_shortening(u))
 
 def shorten_urls_in_text(text: str) -> str:
-    url_pattern = re.compile(r'https?://[^\s]+')
-    urls = url_pattern.findall(text)
-    cache = {}
-    for u in urls:
-        clean_url = u.rstrip(".,;!?")
-        if clean_url not in cache:
-            short = _shorten_with_isgd(clean_url)
-            cache[u] = short if short else u
-    return url_pattern.sub(lambda m: cache.get(m.group(0), m.group(0)), text)
-
-def _sms_fragments(length: int) -> int:
-    return (length + 159) // 160
+    masked_text, urls = mask_urls(text)
+    return unmask_urls(masked_text, finish_url_shortening(start_url_shortening(urls), urls))
+
+def _max_tokens(max_chars: int, target_language: str, n_links: int) -> int:
+    # ~3+ chars per token in English; other scripts can be close to a token per char,
+    # and translations aren't hard-capped, so they get that worst case (rarely more).
+    # Each __URLn__ token costs a few tokens of its own. A lower declared max also
+    # lets OpenAI schedule the request sooner.
+    if target_language == "English":
+        budget = math.ceil(max_chars / 3) + 8
+    else:
+        budget = max_chars + 16
+    return max(MIN_MAX_TOKENS, budget + 6 * n_links)
+
+@contextlib.contextmanager
+def _openai_stream(messages: list[dict], max_tokens: int):
+    """Open a streamed completion under the rate limits; leaving the block hangs up."""
+    OPENAI_BREAKER.check()
+    OPENAI_REQUEST_BUCKET.acquire()
+    # OpenAI counts ~4 chars/token of prompt plus the full max_tokens against TPM
+    OPENAI_TOKEN_BUCKET.acquire(sum(len(m["content"]) for m in messages) // 4 + max_tokens)
+    try:
+        with OPENAI_SEMAPHORE, client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=messages,
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True},
+        ) as stream:
+            yield stream
+    # Still failing after the SDK's own retries (timeouts count as connection errors)
+    except (APIConnectionError, InternalServerError, RateLimitError):
+        OPENAI_BREAKER.record_failure()
+        raise
+    OPENAI_BREAKER.record_success()
+
+def _call_openai(messages: list[dict], max_tokens: int, stop_at: int | None = None) -> tuple[str, int | None]:
+    """Stream the completion; if stop_at is set, hang up once that many chars have arrived.
+
+    Returns the text and the total token count (None when the stream was cut short).
+    """
+    text = ""
+    total_tokens = None
+    with _openai_stream(messages, max_tokens) as stream:
+        for chunk in stream:
+            if chunk.usage:
+                total_tokens = chunk.usage.total_tokens
+            if chunk.choices:
+                text += chunk.choices[0].delta.content or ""
+                # Anything past the cap would be truncated anyway; stop paying for it
+                if stop_at is not None and len(text) >= stop_at:
+                    break
+    return text, total_tokens
+
+def _sms_fragments(text: str) -> int:
+    """Parts needed to send `text`: GSM-7 fits 160 chars (153 per part once split),
+    anything outside that alphabet goes as UCS-2 with 70 (67 per part)."""
+    if _NON_GSM_RE.search(text) is None:
+        # Extension characters are sent as an escape plus the character
+        units, single, part = len(text) + len(_GSM_EXTENDED_RE.findall(text)), 160, 153
+    else:
+        units, single, part = len(text.encode("utf-16-le")) // 2, 70, 67
+    if units <= single:
+        return 1 if units else 0
+    return -(-units // part)
+
+def _prompt_budget(max_chars: int, urls: list[str]) -> int:
+    # Leave room for the real links, which are longer than their tokens
+    budget = max_chars - sum(
+        (ISGD_LINK_LENGTH if _worth_shortening(u) else len(u)) - len(_url_token(i)) for i, u in enumerate(urls)
+    )
+    return max(budget, max_chars // 2)
+
+def _task_details(business_sector: str, protect_variables: bool) -> str:
+    details = f"Tone: {business_sector}."
+    if protect_variables:
+        details += "\nCRITICAL: Do NOT change, delete, or translate any text inside [square brackets] (e.g. [Date]). Keep them exactly as is."
+    return details
+
+@functools.lru_cache(maxsize=256)
+def _user_prompt_prefix(budget: int, business_sector: str, protect_variables: bool, target_language: str) -> str:
+    # Only a handful of option combinations are in use at any time, so build each
+    # once and append the message per call.
+    if target_language and target_language != "English":
+        task = f"Task: Translate the message to {target_language} FIRST, and THEN shorten the translated text to under {budget} characters."
+    else:
+        task = f"Task: Shorten the message to under {budget} characters in English."
+    return f"{task}\n{_task_details(business_sector, protect_variables)}\n\nMessage to process: "
+
+def build_messages(masked_text: str, budget: int, business_sector: str, protect_variables: bool, target_language: str) -> list[dict]:
+    return [
+        {"role": "system", "content": STATIC_PROMPT_HEADER},
+        {"role": "user", "content": _user_prompt_prefix(budget, business_sector, protect_variables, target_language) + masked_text},
+    ]
+
+def finalise_result(completion: str, masked_text: str, links: list[str], max_chars: int, target_language: str) -> dict:
+    processed_text = unmask_urls(masked_text, links)
+    shortened_text = unmask_urls(completion.strip(), links)
+
+    if target_language == "English" and len(shortened_text) > max_chars:
+        shortened_text = shortened_text[:max_chars].rstrip(CAP_TRIM_CHARS)
+
+    return {
+        "original_text": processed_text,
+        "shortened_text": shortened_text,
+        "original_length": len(processed_text),
+        "shortened_length": len(shortened_text),
+        "sms_fragments": _sms_fragments(shortened_text)
+    }
+
+def _fit_as_is(masked_text: str, urls: list[str], shortening, max_chars: int,
+               target_language: str) -> tuple[str, list[str]] | None:
+    """(text, links) if the message already fits with only whitespace tidied, so the model can be skipped."""
+    # Never when translating. The masked text is never longer than the final one,
+    # so only near-fits wait on is.gd.
+    if target_language not in (None, "", "English"):
+        return None
+    candidate = _SPACES_RE.sub(" ", masked_text).strip()
+    if len(candidate) > max_chars:
+        return None
+    links = finish_url_shortening(shortening, urls)
+    if len(unmask_urls(candidate, links)) > max_chars:
+        return None
+    return candidate, links
+
+def shorten_message(original_text: str, max_chars: int, do_shorten_urls: bool, business_sector: str,
+                    protect_variables: bool, target_language: str) -> tuple[dict, int | None, bool]:
+    """Shorten one SMS; returns the response payload, the OpenAI token count and
+    whether every link that was worth shortening got its short link."""
+    # Links are swapped for __URLn__ tokens so is.gd runs while the model works;
+    # the short links are spliced back into the model's output afterwards.
+    masked_text, urls = original_text, []
+    if do_shorten_urls:
+        masked_text, urls = mask_urls(original_text)
+    shortening = start_url_shortening(urls)
+
+    as_is = _fit_as_is(masked_text, urls, shortening, max_chars, target_language)
+    if as_is:
+        text, links = as_is
+        return finalise_result(text, masked_text, links, max_chars, target_language), 0, _all_shortened(urls, links)
+
+    if COALESCER.window:
+        result, total_tokens = COALESCER.submit(masked_text, urls, shortening, max_chars, business_sector, protect_variables, target_language)
+    else:
+        result, total_tokens = complete_message(masked_text, urls, shortening, max_chars, business_sector, protect_variables, target_language)
+    # Settled by now, so these are the links in the payload
+    return result, total_tokens, _all_shortened(urls, finish_url_shortening(shortening, urls))
+
+def _completion_key(masked_text: str, max_chars: int, budget: int, business_sector: str,
+                    protect_variables: bool, target_language: str) -> bytes:
+    return _request_key(masked_text, max_chars, budget, business_sector, protect_variables, target_language)
+
+def _split_tokens(total_tokens: int | None, n: int) -> list[int | None]:
+    # Each of n messages answered by one call gets its share, so per-request logs add up
+    if total_tokens is None:
+        return [None] * n
+    return [total_tokens // n + (i < total_tokens % n) for i in range(n)]
+
+def complete_message(masked_text: str, urls: list[str], shortening, max_chars: int, business_sector: str,
+                     protect_variables: bool, target_language: str) -> tuple[dict, int | None]:
+    """Run the model on an already-masked message while its is.gd lookups (`shortening`) finish."""
+    # Keyed on the masked text, so messages that differ only in their links
+    # (e.g. per-recipient tracking URLs) share one completion. The budget depends
+    # on the link lengths, so it's part of the key too.
+    budget = _prompt_budget(max_chars, urls)
+    key = _completion_key(masked_text, max_chars, budget, business_sector, protect_variables, target_language)
+    with COMPLETION_CACHE_LOCK:
+        completion = COMPLETION_CACHE.get(key)
+
+    total_tokens = 0
+    if completion is None:
+        messages = build_messages(masked_text, budget, business_sector, protect_variables, target_language)
+
+        # English output is hard-capped, so the stream can stop just past max_chars.
+        # The masked text is never longer than the final text, so this never stops early.
+        stop_at = max_chars + 8 if target_language == "English" else None
+        completion, total_tokens = _call_openai(messages, _max_tokens(max_chars, target_language, len(urls)), stop_at)
+        with COMPLETION_CACHE_LOCK:
+            COMPLETION_CACHE[key] = completion
+
+    links = finish_url_shortening(shortening, urls)
+    return finalise_result(completion, masked_text, links, max_chars, target_language), total_tokens
+
+def stream_message(original_text: str, max_chars: int, do_shorten_urls: bool, business_sector: str,
+                   protect_variables: bool, target_language: str):
+    """Yield the shortened SMS as the model writes it, with real links and the English hard cap applied."""
+    masked_text, urls = original_text, []
+    if do_shorten_urls:
+        masked_text, urls = mask_urls(original_text)
+    shortening = start_url_shortening(urls)
+
+    as_is = _fit_as_is(masked_text, urls, shortening, max_chars, target_language)
+    if as_is:
+        yield unmask_urls(*as_is)
+        return
+
+    messages = build_messages(masked_text, _prompt_budget(max_chars, urls), business_sector, protect_variables, target_language)
+    links = None
+    pending, sent = "", 0
+
+    def release(text: str):
+        # Returns what can go out now, and whether the cap has been reached
+        nonlocal links, sent
+        if links is None and "__URL" in text:
+            links = finish_url_shortening(shortening, urls)
+        text = unmask_urls(text, links or [])
+        if target_language == "English" and sent + len(text) > max_chars:
+            # Held-back spaces/punctuation were never sent, so this trims like finalise_result
+            return text[:max_chars - sent].rstrip(CAP_TRIM_CHARS), True
+        sent += len(text)
+        return text, False
+
+    deltas = queue.SimpleQueue()  # text deltas, then None at the end (or the exception)
+    stop = threading.Event()
+
+    def read_completion():
+        try:
+            with _openai_stream(messages, _max_tokens(max_chars, target_language, len(urls))) as stream:
+                for chunk in stream:
+                    if stop.is_set():
+                        break  # capped, or the caller went away
+                    if chunk.choices:
+                        deltas.put(chunk.choices[0].delta.content or "")
+        except Exception as e:
+            deltas.put(e)
+            return
+        deltas.put(None)
+
+    STREAM_POOL.submit(read_completion)
+    try:
+        while (delta := deltas.get()) is not None:
+            if isinstance(delta, Exception):
+                raise delta
+            pending += delta
+            if not sent:
+                pending = pending.lstrip()
+            cut = _STREAM_HOLD_RE.search(pending).start()
+            if cut:
+                text, capped = release(pending[:cut])
+                pending = pending[cut:]
+                yield text
+                if capped:
+                    return
+    finally:
+        stop.set()
+
+    text, _ = release(pending.rstrip())
+    if text:
+        yield text
+
+def _log_stream_errors(first: str, chunks):
+    # The status has gone out with the first piece; a later failure can only end the body
+    yield first
+    try:
+        yield from chunks
+    except Exception as e:
+        logger.error(f"AI Error (stream): {str(e)}")
+
+def build_batch_messages(masked_texts: list[str], budgets: list[int], business_sector: str,
+                         protect_variables: bool, target_language: str) -> list[dict]:
+    limits = ", ".join(f"{i} -> {b}" for i, b in enumerate(budgets, 1))
+    if target_language and target_language != "English":
+        task = f"Task: Translate EACH numbered message to {target_language} FIRST, and THEN shorten it to under its character limit ({limits})."
+    else:
+        task = f"Task: Shorten EACH numbered message to under its character limit ({limits}) in English."
+
+    messages = "\n".join(f"{_batch_marker(i)}\n{t}" for i, t in enumerate(masked_texts, 1))
+    return [
+        {"role": "system", "content": STATIC_PROMPT_HEADER},
+        {"role": "user", "content": f"""{task}
+{_task_details(business_sector, protect_variables)}
+Shorten every message on its own; never merge them.
+Reply with every message in order: its marker line (e.g. {_batch_marker(1)}) exactly as given, then ONLY its final SMS text.
+
+Messages to process:
+{messages}"""},
+    ]
+
+def _batch_marker(i: int) -> str:
+    return f"### {i} ###"
+
+def split_batch_completion(completion: str, count: int) -> list[str] | None:
+    """Split a numbered batch reply back into per-message texts; None if it doesn't line up."""
+    parts = _BATCH_MARKER_RE.split(completion)
+    # parts = [preamble, "1", text1, "2", text2, ...]
+    numbers = [int(n) for n in parts[1::2]]
+    if numbers != list(range(1, count + 1)):
+        return None
+    return parts[2::2]
+
+def complete_batch(masked: list[tuple[str, list[str]]], shortenings: list, max_chars: list[int], business_sector: str,
+                   protect_variables: bool, target_language: str) -> tuple[list[dict], list[int | None]]:
+    """Shorten several masked messages in one completion; falls back to one call each if the reply won't split.
+
+    Cached completions are reused and only the rest are sent. Returns the results and
+    each message's share of the tokens spent.
+    """
+    n = len(masked)
+    budgets = [_prompt_budget(mc, urls) for mc, (_, urls) in zip(max_chars, masked)]
+    keys = [_completion_key(masked_text, mc, budget, business_sector, protect_variables, target_language)
+            for (masked_text, _), mc, budget in zip(masked, max_chars, budgets)]
+    with COMPLETION_CACHE_LOCK:
+        completions = [COMPLETION_CACHE.get(key) for key in keys]
+    misses = [i for i in range(n) if completions[i] is None]
+    results: list[dict | None] = [None] * n
+    tokens: list[int | None] = [0] * n
+
+    single = misses
+    if len(misses) > 1:
+        messages = build_batch_messages([masked[i][0] for i in misses], [budgets[i] for i in misses],
+                                        business_sector, protect_variables, target_language)
+        max_tokens = sum(_max_tokens(max_chars[i], target_language, len(masked[i][1])) + 8 for i in misses)
+        completion, total_tokens = _call_openai(messages, max_tokens)
+        for i, share in zip(misses, _split_tokens(total_tokens, len(misses))):
+            tokens[i] = share
+
+        replies = split_batch_completion(completion, len(misses))
+        if replies is not None:
+            with COMPLETION_CACHE_LOCK:
+                for i, reply in zip(misses, replies):
+                    completions[i] = COMPLETION_CACHE[keys[i]] = reply
+            single = []
+        else:
+            logger.warning(f"Batch reply unparseable, falling back to {len(misses)} single calls")
+
+    # A lone miss, or a reply that didn't split cleanly: shorten each on its own,
+    # concurrently. The is.gd lookups started by the caller are handed over as-is.
+    def complete_one(i: int):
+        return complete_message(masked[i][0], masked[i][1], shortenings[i], max_chars[i],
+                                business_sector, protect_variables, target_language)
+
+    if len(single) == 1:
+        outcomes = {single[0]: complete_one(single[0])}
+    else:
+        futures = {i: FALLBACK_POOL.submit(complete_one, i) for i in single}
+        outcomes = {i: fut.result() for i, fut in futures.items()}
+    for i, (result, spent) in outcomes.items():
+        results[i] = result
+        tokens[i] = None if tokens[i] is None or spent is None else tokens[i] + spent
+
+    for i, ((masked_text, urls), shortening, mc) in enumerate(zip(masked, shortenings, max_chars)):
+        if results[i] is None:
+            results[i] = finalise_result(completions[i], masked_text, finish_url_shortening(shortening, urls),
+                                         mc, target_language)
+    return results, tokens
+
+def parse_batch_output(lines: list[bytes], target_language: str) -> list[dict]:
+    """Turn Batch API output lines into per-item results, ordered by the index in their custom_id."""
+    results = []
+    for line in lines:
+        if not line.strip():
+            continue
+        row = orjson.loads(line)
+        _, index, max_chars = row["custom_id"].split("-", 2)
+        result = {"index": int(index)}
+        response = row.get("response") or {}
+        if response.get("status_code") == 200:
+            completion = response["body"]["choices"][0]["message"]["content"] or ""
+            result.update(finalise_result(completion, "", [], int(max_chars), target_language))
+            del result["original_text"], result["original_length"]  # the input isn't kept
+        else:
+            error = row.get("error") or response.get("body", {}).get("error") or {}
+            result["error"] = error.get("message", "Request failed")
+        results.append(result)
+    return sorted(results, key=lambda r: r["index"])
+
+def _batch_items(data: dict, max_items: int) -> tuple[list[str], list[int]]:
+    """Validate a batch body; returns the texts and their max_chars (item value or top-level default)."""
+    items = data.get("items") or []
+    default_max_chars = int(data.get("max_chars", 160))
+    if not isinstance(items, list) or not items:
+        raise ValueError("No items provided")
+    if len(items) > max_items:
+        raise ValueError(f"Too many items (max {max_items})")
+    if not all(isinstance(item, dict) and item.get("text") for item in items):
+        raise ValueError("Every item needs text")
+    max_chars = [int(item.get("max_chars", default_max_chars)) for item in items]
+    if min(max_chars) <= 0:
+        raise ValueError("max_chars must be positive")
+    return [item["text"] for item in items], max_chars
+
+def _request_key(*params) -> bytes:
+    return hashlib.blake2b(orjson.dumps(params), digest_size=16).digest()
+
+def _singleflight(key: bytes, fn, *args):
+    """Run fn(*args) once per key at a time; concurrent callers with the same key share its outcome."""
+    with INFLIGHT_LOCK:
+        fut = INFLIGHT.get(key)
+        leader = fut is None
+        if leader:
+            fut = INFLIGHT[key] = Future()
+    if not leader:
+        return fut.result()
+
+    try:
+        result = fn(*args)
+        fut.set_result(result)
+        return result
+    except Exception as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        with INFLIGHT_LOCK:
+            del INFLIGHT[key]
+
+def _shorten_and_cache(key: bytes, *params) -> tuple[dict, int | None]:
+    result, total_tokens, all_shortened = shorten_message(*params)
+    # A payload still carrying long URLs would outlive the is.gd failure behind
+    # them (ISGD_FAILURE_TTL, the breaker reset), so it isn't kept
+    if all_shortened:
+        with RESP_CACHE_LOCK:
+            RESP_CACHE[key] = result
+    return result, total_tokens
 
 # --- ROUTES ---
 @app.route('/shorten', methods=['POST'])
@@ -58,72 +824,173 @@ def shorten_sms():
     original_text = data.get("text", "")
     max_chars = int(data.get("max_chars", 160))
     do_shorten_urls = bool(data.get("shorten_urls", True))
-    business_sector = data.get("business_sector", "General")
+    business_sector = str(data.get("business_sector") or "General")
     protect_variables = bool(data.get("protect_variables", True))
-    target_language = data.get("target_language", "English")
+    target_language = str(data.get("target_language") or "English")
 
     if not original_text:
         return jsonify({"error": "No text provided"}), 400
+    if max_chars <= 0:
+        return jsonify({"error": "max_chars must be positive"}), 400
+
+    params = (original_text, max_chars, do_shorten_urls, business_sector, protect_variables, target_language)
+    if data.get("stream"):
+        # Plain text, sent as the model writes it; the JSON summary needs the
+        # finished text, and nothing here is cached.
+        logger.info(f"Streaming: Lang={target_language} | Sector={business_sector} | Length={len(original_text)}")
+        chunks = stream_message(*params)
+        # Run up to the first piece here, so anything failing before output
+        # still gets an error status rather than an empty 200
+        try:
+            first = next(chunks, "")
+        except CircuitOpenError as e:
+            return jsonify({"error": str(e)}), 503
+        except Exception as e:
+            logger.error(f"AI Error (stream): {str(e)}")
+            return jsonify({"error": str(e)}), 500
+        return Response(stream_with_context(_log_stream_errors(first, chunks)), mimetype="text/plain")
+
+    key = _request_key(*params)
+    with RESP_CACHE_LOCK:
+        cached = RESP_CACHE.get(key)
+    if cached is not None:
+        logger.info(f"Cache hit: Length={len(original_text)}")
+        return jsonify(cached)
 
     # Log the attempt (Privacy safe: don't log the actual PII text)
     logger.info(f"Processing: Lang={target_language} | Sector={business_sector} | Length={len(original_text)}")
 
-    processed_text = original_text
-    if do_shorten_urls:
-        processed_text = shorten_urls_in_text(processed_text)
+    try:
+        result, total_tokens = _singleflight(key, _shorten_and_cache, key, *params)
 
-    # --- PROMPT ENGINEERING ---
-    role = "You are a precise SMS message shortener and translator."
-    
-    protection = ""
-    if protect_variables:
-        protection = "CRITICAL: Do NOT change, delete, or translate any text inside [square brackets] (e.g. [Date]). Keep them exactly as is."
+        # Log Success
+        duration = round(time.time() - start_time, 2)
+        logger.info(f"Success: {duration}s | Old:{len(original_text)} -> New:{result['shortened_length']} | Tokens: {total_tokens if total_tokens is not None else 'n/a (stream cut)'}")
 
-    if target_language and target_language != "English":
-        task = f"Task: Translate the message to {target_language} FIRST, and THEN shorten the translated text to under {max_chars} characters."
-    else:
-        task = f"Task: Shorten the message to under {max_chars} characters in English."
-
-    prompt = f"""
-    {role}
-    {task}
-    
-    Rules:
-    - Maintain the original meaning.
-    - Tone: {business_sector}.
-    - {protection}
-    - If multiple links exist, keep them all.
-    - Provide ONLY the final SMS text. No intro/outro.
-    
-    Message to process: {processed_text}
-    """
+        return jsonify(result)
+
+    except CircuitOpenError as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        logger.error(f"AI Error: {str(e)}") # <--- LOG ERROR
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/shorten_batch', methods=['POST'])
+def shorten_sms_batch():
+    start_time = time.time()
+    data = request.json or {}
+    do_shorten_urls = bool(data.get("shorten_urls", True))
+    business_sector = str(data.get("business_sector") or "General")
+    protect_variables = bool(data.get("protect_variables", True))
+    target_language = str(data.get("target_language") or "English")
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "system", "content": prompt}],
-            max_tokens=max_chars + 100, 
-        )
+        texts, max_chars = _batch_items(data, BATCH_MAX_ITEMS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-        shortened_text = (response.choices[0].message.content or "").strip()
+    logger.info(f"Processing batch: Items={len(texts)} | Lang={target_language} | Sector={business_sector} | Length={sum(map(len, texts))}")
 
-        if target_language == "English" and len(shortened_text) > max_chars:
-            shortened_text = shortened_text[:max_chars].rstrip(". ,")
+    try:
+        # One chat completion for the whole batch, with is.gd running alongside it
+        masked = [mask_urls(t) if do_shorten_urls else (t, []) for t in texts]
+        shortenings = [start_url_shortening(urls) for _, urls in masked]
+        results, tokens = complete_batch(masked, shortenings, max_chars, business_sector, protect_variables, target_language)
+        total_tokens = None if None in tokens else sum(tokens)
 
-        # Log Success
         duration = round(time.time() - start_time, 2)
-        logger.info(f"Success: {duration}s | Old:{len(original_text)} -> New:{len(shortened_text)} | Tokens: {response.usage.total_tokens}")
+        logger.info(f"Batch success: {duration}s | Items:{len(texts)} | Tokens: {total_tokens}")
 
-        return jsonify({
-            "original_text": processed_text,
-            "shortened_text": shortened_text,
-            "original_length": len(processed_text),
-            "shortened_length": len(shortened_text),
-            "sms_fragments": _sms_fragments(len(shortened_text))
-        })
+        return jsonify({"results": results})
 
+    except CircuitOpenError as e:
+        return jsonify({"error": str(e)}), 503
     except Exception as e:
-        logger.error(f"AI Error: {str(e)}") # <--- LOG ERROR
+        logger.error(f"AI Error (batch): {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/shorten_async', methods=['POST'])
+def shorten_sms_async():
+    """Queue a batch on the OpenAI Batch API (half price, off the live rate limits); poll /shorten_result."""
+    data = request.json or {}
+    do_shorten_urls = bool(data.get("shorten_urls", True))
+    business_sector = str(data.get("business_sector") or "General")
+    protect_variables = bool(data.get("protect_variables", True))
+    target_language = str(data.get("target_language") or "English")
+    correlation_id = str(data.get("correlation_id", ""))[:512]
+
+    try:
+        texts, max_chars = _batch_items(data, ASYNC_MAX_ITEMS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    logger.info(f"Queueing async batch: Items={len(texts)} | Lang={target_language} | Sector={business_sector}")
+
+    try:
+        # Links are shortened now, in one fan-out across every item, since the
+        # completions come back long after this request has finished.
+        masked = [mask_urls(t) if do_shorten_urls else (t, []) for t in texts]
+        all_urls = list({u for _, urls in masked for u in urls})
+        short = dict(zip(all_urls, finish_url_shortening(start_url_shortening(all_urls), all_urls)))
+
+        lines = []
+        for i, ((masked_text, urls), mc) in enumerate(zip(masked, max_chars)):
+            processed_text = unmask_urls(masked_text, [short[u] for u in urls])
+            messages = build_messages(processed_text, mc, business_sector, protect_variables, target_language)
+            lines.append(orjson.dumps({
+                # max_chars rides along in the id so results can be capped without local state
+                "custom_id": f"item-{i}-{mc}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": OPENAI_MODEL,
+                    "messages": messages,
+                    "max_tokens": _max_tokens(mc, target_language, 0),
+                },
+            }))
+
+        batch_file = client.files.create(file=("shorten.jsonl", b"\n".join(lines)), purpose="batch")
+        batch = client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+            metadata={"correlation_id": correlation_id, "target_language": str(target_language)},
+        )
+        return jsonify({"job_id": batch.id, "status": batch.status, "correlation_id": correlation_id}), 202
+
+    except Exception as e:
+        logger.error(f"AI Error (async batch): {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/shorten_result/<job_id>', methods=['GET'])
+def shorten_result(job_id):
+    """Batch status; once complete, per-item results (or the raw output JSONL with ?format=jsonl)."""
+    try:
+        batch = client.batches.retrieve(job_id)
+        metadata = batch.metadata or {}
+        payload = {
+            "job_id": batch.id,
+            "status": batch.status,
+            "correlation_id": metadata.get("correlation_id"),
+        }
+        if batch.status != "completed":
+            return jsonify(payload)
+
+        if request.args.get("format") == "jsonl" and batch.output_file_id:
+            # Stream the raw output JSONL (one line per custom_id) straight through
+            output = client.files.content(batch.output_file_id)
+            return Response(output.iter_bytes(), mimetype="application/x-ndjson")
+
+        # Failed requests land in the error file rather than the output file
+        lines = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                lines.extend(client.files.content(file_id).content.splitlines())
+        payload["results"] = parse_batch_output(lines, metadata.get("target_language", "English"))
+        return jsonify(payload)
+
+    except Exception as e:
+        logger.error(f"AI Error (async result): {str(e)}")
         return jsonify({"error": str(e)}), 500
 
 @app.route('/health', methods=['GET'])
@@ -131,4 +998,7 @@ def health():
     return jsonify({"status": "ok"}), 200
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=int(os.getenv("PORT", 5000)))
\ No newline at end of file
+    # Cooperative server: one process keeps many is.gd/OpenAI waits in flight
+    from gevent.pywsgi import WSGIServer
+
+    WSGIServer(("0.0.0.0", int(os.getenv("PORT", 5000))), app).serve_forever()
\ No newline at end of file
@@ -1,28 +1,42 @@
+import atexit
 import json
 import os
+import queue
 import re
+import sqlite3
+import threading
 import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 import requests
 from flask import Flask, request, jsonify
 from openai import OpenAI
 from flask_cors import CORS
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 
 # -----------------------------
 # Config / constants
 # -----------------------------
 ISGD_API = "https://is.gd/create.php?format=simple&url="
 SMS_COST_PER_FRAGMENT = 0.0225  # £ per 160-char fragment
-STATS_FILE = "stats.json"
+STATS_DB = "stats.db"
+STATS_FILE = "stats.json"  # legacy store, only read to seed a new stats.db
+STATS_FLUSH_INTERVAL = 5  # seconds between batched stats writes
+ISGD_MAX_WORKERS = 8  # max parallel is.gd lookups per message
 
 # Optional: remove https:// from short domains to save chars
 REMOVE_SCHEME_FOR_SHORTENERS = False
 SHORTENER_HOSTS = (r"is\.gd",)
 
-# HTTP session (keep-alive + UA)
+# Compiled once at import rather than per call
+_URL_RE = re.compile(r'https?://\S+')
+_SHORTENER_SCHEME_RE = re.compile(rf'https?://((?:{"|".join(SHORTENER_HOSTS)})/)', re.IGNORECASE)
+
+# HTTP session (keep-alive + UA), pooled for parallel is.gd lookups
 SESSION = requests.Session()
 SESSION.headers.update({"User-Agent": "TxtTrim/1.0"})
+SESSION.mount("https://", HTTPAdapter(pool_connections=ISGD_MAX_WORKERS, pool_maxsize=ISGD_MAX_WORKERS))
 
 # -----------------------------
 # Flask app
@@ -34,22 +48,82 @@ load_dotenv()
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 # -----------------------------
-# Stats file bootstrap
+# Stats (SQLite, WAL mode)
 # -----------------------------
-if not os.path.exists(STATS_FILE):
-    with open(STATS_FILE, "w") as f:
-        json.dump(
-            {"total_sms_shortened": 0, "total_characters_saved": 0, "total_cost_saved": 0.0},
-            f,
-        )
+# A single-row table updated in place: each request is one atomic UPDATE,
+# safe across threads and across gunicorn worker processes.
+STATS_CONN = sqlite3.connect(STATS_DB, check_same_thread=False, isolation_level=None)
+STATS_CONN.execute("PRAGMA journal_mode=WAL")
+STATS_CONN.execute("PRAGMA synchronous=NORMAL")
+STATS_CONN.execute("PRAGMA busy_timeout=5000")
+STATS_LOCK = threading.Lock()  # one connection is shared by the writer and /stats
+STATS_Q = queue.SimpleQueue()  # (characters_saved, cost_savings) per shortened SMS
+
+def _init_stats_db():
+    """Create the stats row on first run, seeded from the old stats.json if present."""
+    seed = {"total_sms_shortened": 0, "total_characters_saved": 0, "total_cost_saved": 0.0}
+    if os.path.exists(STATS_FILE):
+        with open(STATS_FILE, "r") as f:
+            seed.update(json.load(f))
+    STATS_CONN.execute(
+        """CREATE TABLE IF NOT EXISTS stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_sms_shortened INTEGER NOT NULL,
+            total_characters_saved INTEGER NOT NULL,
+            total_cost_saved REAL NOT NULL
+        )"""
+    )
+    STATS_CONN.execute(
+        "INSERT OR IGNORE INTO stats VALUES (1, :total_sms_shortened, :total_characters_saved, :total_cost_saved)",
+        seed,
+    )
+
+_init_stats_db()
 
 def load_stats():
-    with open(STATS_FILE, "r") as f:
-        return json.load(f)
+    with STATS_LOCK:
+        row = STATS_CONN.execute(
+            "SELECT total_sms_shortened, total_characters_saved, total_cost_saved FROM stats WHERE id = 1"
+        ).fetchone()
+    return {"total_sms_shortened": row[0], "total_characters_saved": row[1], "total_cost_saved": row[2]}
+
+def record_stats(characters_saved: int, cost_savings: float):
+    """Queue the deltas; the request never waits on the lock or the database."""
+    STATS_Q.put((characters_saved, cost_savings))
+
+def _flush_stats():
+    """Fold everything queued so far into a single UPDATE."""
+    count, characters_saved, cost_savings = 0, 0, 0.0
+    while True:
+        try:
+            chars, cost = STATS_Q.get_nowait()
+        except queue.Empty:
+            break
+        count += 1
+        characters_saved += chars
+        cost_savings += cost
+    if not count:
+        return
+    with STATS_LOCK:
+        STATS_CONN.execute(
+            """UPDATE stats SET
+                total_sms_shortened = total_sms_shortened + ?,
+                total_characters_saved = total_characters_saved + ?,
+                total_cost_saved = total_cost_saved + ?
+            WHERE id = 1""",
+            (count, characters_saved, cost_savings),
+        )
+
+def _stats_writer():
+    while True:
+        time.sleep(STATS_FLUSH_INTERVAL)
+        try:
+            _flush_stats()
+        except Exception as e:
+            print(f"[stats] Flush failed: {e}")
 
-def save_stats(stats):
-    with open(STATS_FILE, "w") as f:
-        json.dump(stats, f)
+threading.Thread(target=_stats_writer, daemon=True).start()
+atexit.register(_flush_stats)
 
 # -----------------------------
 # URL Shortening (is.gd only)
@@ -74,20 +148,25 @@ def shorten_single_url(url: str) -> str:
     return short or url
 
 def shorten_urls_in_text(text: str) -> str:
-    """Find http/https URLs and replace with shortened ones (deduped)."""
-    url_pattern = re.compile(r'https?://\S+')
-    urls = url_pattern.findall(text)
-    cache: dict[str, str] = {}
+    """Find http/https URLs and replace with shortened ones (deduped, shortened in parallel).
 
-    for u in urls:
-        if u not in cache:
-            cache[u] = shorten_single_url(u)
+    The text is scanned once; the recorded match spans are then spliced with the results.
+    """
+    matches = list(_URL_RE.finditer(text))
+    if not matches:
+        return text
+    unique = list({m.group(0) for m in matches})
 
-    def repl(m):
-        u = m.group(0)
-        return cache.get(u, u)
+    with ThreadPoolExecutor(max_workers=min(ISGD_MAX_WORKERS, len(unique))) as pool:
+        cache: dict[str, str] = dict(zip(unique, pool.map(shorten_single_url, unique)))
 
-    return url_pattern.sub(repl, text)
+    out, last = [], 0
+    for m in matches:
+        out.append(text[last:m.start()])
+        out.append(cache[m.group(0)])
+        last = m.end()
+    out.append(text[last:])
+    return "".join(out)
 
 def strip_scheme_from_shorteners(text: str) -> str:
     """
@@ -96,9 +175,8 @@ def strip_scheme_from_shorteners(text: str) -> str:
     """
     if not REMOVE_SCHEME_FOR_SHORTENERS:
         return text
-    host_regex = "|".join(SHORTENER_HOSTS)
-    pattern = re.compile(rf'https?://(?:{host_regex})/', re.IGNORECASE)
-    return pattern.sub(lambda m: m.group(0).split("://", 1)[1], text)
+    # Template replacement keeps the host/ group without a Python callback per match
+    return _SHORTENER_SCHEME_RE.sub(r"\1", text)
 
 # -----------------------------
 # SMS helpers
@@ -168,12 +246,7 @@ Original message: {processed_text}
         new_sms_count = _sms_fragments(shortened_length, 160)
         cost_savings = max(0.0, (original_sms_count - new_sms_count) * SMS_COST_PER_FRAGMENT)
 
-        # Persist stats
-        stats = load_stats()
-        stats["total_sms_shortened"] += 1
-        stats["total_characters_saved"] += characters_saved
-        stats["total_cost_saved"] += cost_savings
-        save_stats(stats)
+        record_stats(characters_saved, cost_savings)
 
         return jsonify({
             "original_text": processed_text,         # after shortening URLs (what the model actually saw)
@@ -190,6 +263,14 @@ Original message: {processed_text}
         return jsonify({"error": str(e)}), 500
 
 
+# -----------------------------
+# Stats route
+# -----------------------------
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify(load_stats())
+
+
 # -----------------------------
 # Simple health route (is.gd only)
 # -----------------------------
@@ -0,0 +1,14 @@
+import multiprocessing
+import os
+
+# Every request spends nearly all its time waiting on is.gd and OpenAI, so each
+# worker runs gevent and keeps many requests in flight instead of one at a time.
+# Set GUNICORN_WORKER_CLASS=gthread to use plain threads instead; the thread
+# count then caps concurrent requests per worker, so size it from the OpenAI
+# RPM budget rather than leaving gunicorn's default of 1.
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gevent")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", 500))
+threads = int(os.getenv("GUNICORN_THREADS", 64))
+timeout = 120
@@ -0,0 +1,11 @@
+# Production entrypoint: gunicorn wsgi:app (settings in gunicorn.conf.py)
+# Patch sockets/threads before anything imports requests or openai, so every
+# blocking is.gd/OpenAI wait yields to other requests on the same worker.
+import os
+
+if os.getenv("GUNICORN_WORKER_CLASS", "gevent") == "gevent":
+    from gevent import monkey
+
+    monkey.patch_all()
+
+from app import app  # noqa: E402